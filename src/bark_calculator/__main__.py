@@ -1,6 +1,9 @@
+import matplotlib
+matplotlib.use('Agg')
+
 from dataset import RegressionDatasetFolder, pil_loader
 from utils import *
-from models import fcn_resnet50, deeplabv3_resnet50, fcn_resnet101, deeplabv3_resnet101, fcn_efficientnet, deeplabv3_efficientnet
+from models import InputNormalization, fcn_resnet50, deeplabv3_resnet50, fcn_resnet101, deeplabv3_resnet101, fcn_efficientnet, deeplabv3_efficientnet
 from lovasz_losses import LovaszSoftmax, miou, iou
 
 from torchvision.transforms import *
@@ -8,11 +11,9 @@ from torchvision.transforms import *
 from poutyne.framework import Experiment, ExponentialLR, EarlyStopping, ReduceLROnPlateau
 from torch.utils.data import DataLoader, Subset, WeightedRandomSampler, BatchSampler
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 from torch.nn.modules.loss import CrossEntropyLoss
 from skimage.io import imread, imsave
 
-from sklearn.metrics import f1_score
 from skimage.transform import resize
 from skimage import img_as_ubyte
 import torch
@@ -64,15 +65,12 @@ def make_dual_images():
             bark_path = os.path.join(barks_dir, fname)
             node_path = os.path.join(nodes_dir, fname)
 
-            bark_image = np.asarray(pil_loader(bark_path,
-                                               grayscale=True)) / 255
-            node_image = np.asarray(pil_loader(node_path,
-                                               grayscale=True)) / 255
+            bark_image = np.asarray(pil_loader(bark_path, grayscale=True))
+            node_image = np.asarray(pil_loader(node_path, grayscale=True))
 
-            dual_png = np.zeros((bark_image.shape[0], bark_image.shape[1]),
-                                dtype=np.uint8)
-            dual_png[bark_image == 1.0] = 127
-            dual_png[node_image == 1.0] = 255
+            dual_png = np.where(
+                node_image == 255, np.uint8(255),
+                np.where(bark_image == 255, np.uint8(127), np.uint8(0)))
 
             dual = Image.fromarray(dual_png, mode='L')
             dual.save(os.path.join(duals_dir, fname.replace("bmp", "png")))
@@ -92,15 +90,13 @@ def fine_tune_images():
 
                 dual_path = os.path.join(type_duals_dir, fname)
 
-                dual_image = np.array(
-                    Image.open(open(dual_path, 'rb')).convert('L')) / 127
+                dual_image = np.asarray(
+                    Image.open(open(dual_path, 'rb')).convert('L'))
 
                 dual_image = remove_small_zones(
-                    torch.from_numpy(dual_image).long())
+                    torch.from_numpy((dual_image // 127).astype(np.int64)))
 
-                dual_image = dual_image.numpy().astype(np.uint8)
-                dual_image[dual_image == 1] = 127
-                dual_image[dual_image == 2] = 255
+                dual_image = to_dual_image(dual_image)
 
                 dual = Image.fromarray(dual_image, mode='L')
                 out_path = os.path.join(type_output_dir, fname)
@@ -150,20 +146,22 @@ def test_color_jitter(root_dir):
         plt.show()
 
 
-def get_loader_for_crop_batch(crop_size, batch_size, train_split, mean, std,
-                              train_weights, root_dir):
+def get_loader_for_crop_batch(crop_size,
+                              batch_size,
+                              train_split,
+                              train_weights,
+                              root_dir,
+                              pin_memory=False,
+                              image_cache=None):
     train_dataset = RegressionDatasetFolder(
         os.path.join(root_dir, "Images/1024_with_jedi"),
-        input_only_transform=Compose([Normalize(mean, std)]),
         transform=Compose([
             Lambda(lambda img: pad_resize(img, 1024, 1024)),
             ColorJitter(saturation=0.2, brightness=0.1),
-            RandomCrop(crop_size),
-            RandomHorizontalFlip(),
-            RandomVerticalFlip(),
-            ToTensor()
+            PILToTensor()
         ]),
-        in_memory=True)
+        in_memory=True,
+        image_cache=image_cache)
 
     sampler = BatchSampler(WeightedRandomSampler(
         train_weights, num_samples=len(train_weights) * 12, replacement=True),
@@ -172,8 +170,10 @@ def get_loader_for_crop_batch(crop_size, batch_size, train_split, mean, std,
 
     return DataLoader(Subset(train_dataset, train_split),
                       batch_sampler=sampler,
+                      collate_fn=RandomCropFlipCollate(crop_size),
                       num_workers=8,
-                      pin_memory=False)
+                      pin_memory=pin_memory,
+                      persistent_workers=True)
 
 
 def test_model_on_checkpoint(model, test_loader):
@@ -197,44 +197,61 @@ def test_model_on_checkpoint(model, test_loader):
 
 
 def main(args):
+    device = torch.device(args.device)
+    pin_memory = (args.device != 'cpu')
+
+    # Filled in the main process, when the datasets below are first read or
+    # loaded in memory, so that forked workers all inherit the decoded images.
+    image_cache = {}
+
     raw_dataset = RegressionDatasetFolder(os.path.join(
         args.root_dir, 'Images/1024_with_jedi'),
                                           input_only_transform=None,
-                                          transform=Compose([ToTensor()]))
-    mean, std = compute_mean_std(raw_dataset)
+                                          transform=Compose([ToTensor()]),
+                                          image_cache=image_cache)
+    mean, std, pos_weights = get_cached_stats(
+        raw_dataset, os.path.join(args.root_dir, '.cache'))
     print(mean)
     print(std)
-    pos_weights = compute_pos_weight(raw_dataset)
     print(pos_weights)
     test_dataset = RegressionDatasetFolder(
         os.path.join(args.root_dir, 'Images/1024_with_jedi'),
-        input_only_transform=Compose([Normalize(mean, std)]),
         transform=Compose(
             [Lambda(lambda img: pad_resize(img, 1024, 1024)),
              ToTensor()]),
-        in_memory=True)
+        in_memory=True,
+        image_cache=image_cache)
 
     valid_dataset = RegressionDatasetFolder(
         os.path.join(args.root_dir, 'Images/1024_with_jedi'),
-        input_only_transform=Compose([Normalize(mean, std)]),
         transform=Compose([ToTensor()]),
-        include_fname=True)
+        include_fname=True,
+        image_cache=image_cache)
 
     train_split, valid_split, test_split, train_weights = get_splits(
         valid_dataset)
     valid_loader = DataLoader(Subset(test_dataset, valid_split),
                               batch_size=8,
                               num_workers=8,
-                              pin_memory=False)
+                              pin_memory=pin_memory,
+                              persistent_workers=True)
 
     # module = deeplabv3_efficientnet(n=5)
     module = fcn_resnet50(dropout=0.8)
+    module.normalization = InputNormalization(mean, std)
+
+    if (device.type == 'cuda' and not args.deterministic
+            and torch.cuda.get_device_capability(device)[0] >= 8):
+        # bfloat16 keeps float32's exponent range, so mixed precision
+        # training needs no loss scaling inside poutyne's training step.
+        # Only Ampere and newer GPUs have bfloat16 tensor cores.
+        module.autocast_dtype = torch.bfloat16
     # module = deeplabv3_resnet50()
 
     optim = torch.optim.Adam(module.parameters(), lr=5e-4, weight_decay=2e-3)
     exp = Experiment(directory=os.path.join(args.root_dir, 'moar'),
                      module=module,
-                     device=torch.device(args.device),
+                     device=device,
                      optimizer=optim,
                      loss_function=LovaszSoftmax(),
                      metrics=[miou, PixelWiseF1(None)],
@@ -257,10 +274,17 @@ def main(args):
                       mode='max')
     ]
 
+    # Training crops all have the same shape, so the fastest convolution
+    # algorithms only have to be searched for once. The search makes runs
+    # non deterministic, as does bfloat16 autocast.
+    torch.backends.cudnn.benchmark = not args.deterministic
+    torch.backends.cudnn.deterministic = args.deterministic
+
     for i, (crop_size, batch_size) in enumerate(zip([512], [5])):
         train_loader = get_loader_for_crop_batch(crop_size, batch_size,
-                                                 train_split, mean, std,
-                                                 train_weights, args.root_dir)
+                                                 train_split, train_weights,
+                                                 args.root_dir, pin_memory,
+                                                 image_cache)
 
         exp.train(train_loader=train_loader,
                   valid_loader=valid_loader,
@@ -268,21 +292,27 @@ def main(args):
                   lr_schedulers=lr_schedulers,
                   callbacks=callbacks)
 
+    # The evaluation images have varying heights, each new shape would
+    # trigger a new search
+    torch.backends.cudnn.benchmark = False
+
     raw_dataset.print_filenames()
 
     pure_dataset = RegressionDatasetFolder(os.path.join(
         args.root_dir, 'Images/1024_with_jedi'),
                                            transform=Compose([ToTensor()]),
-                                           include_fname=True)
+                                           include_fname=True,
+                                           image_cache=image_cache)
 
     test_loader = DataLoader(Subset(test_dataset, test_split),
                              batch_size=8,
                              num_workers=8,
-                             pin_memory=False)
+                             pin_memory=pin_memory)
+    size_batches = get_same_size_batches(valid_dataset, batch_size=8)
     valid_loader = DataLoader(valid_dataset,
-                              batch_size=1,
+                              batch_sampler=size_batches,
                               num_workers=8,
-                              pin_memory=False)
+                              pin_memory=pin_memory)
     pure_loader = DataLoader(pure_dataset,
                              batch_size=1,
                              num_workers=8,
@@ -304,15 +334,56 @@ def main(args):
     splits = [(train_split, 'train'), (valid_split, 'valid'),
               (test_split, 'test')]
 
-    results_csv = [[
+    split_of = np.empty(len(valid_dataset), dtype=object)
+
+    for split_idxs, split_name in splits:
+        split_of[np.asarray(split_idxs, dtype=int)] = split_name
+
+    csv_header = [
         'Name', 'Type', 'Split', 'iou_nothing', 'iou_bark', 'iou_node',
         'iou_mean', 'f1_nothing', 'f1_bark', 'f1_node', 'f1_mean',
         'Output Bark %', 'Output Node %', 'Target Bark %', 'Target Node %'
-    ]]
+    ]
+    csv_file = os.path.join(args.root_dir, 'Images', 'results', 'moar',
+                            'final_stats.csv')
+
+    # Network outputs are computed in batches first, the per image
+    # plotting and stats are then done from the stored predictions
+    predictions = [None] * len(valid_dataset)
 
     with torch.no_grad():
-        for image_number, (batch, pure_batch) in enumerate(
-                zip(valid_loader, pure_loader)):
+        for batch_idxs, batch in zip(size_batches, valid_loader):
+            targets = batch[1].to(device, non_blocking=True)
+            outputs = module.predict(batch[0].to(device, non_blocking=True))
+            classes = torch.argmax(outputs, dim=1)
+
+            for i, image_number in enumerate(batch_idxs):
+                output = outputs[i:i + 1]
+                target = targets[i:i + 1]
+
+                try:
+                    class_accs = iou(output, target)
+                    f1s = PixelWiseF1('all')(output, target) * 100
+                except ValueError as e:
+                    print('Error on file {}'.format(batch[2][i]))
+                    print(output.shape)
+                    print(target.shape)
+                    raise e
+
+                # Saved maps and class percentages come from the raw argmax,
+                # only the F1 scores are computed on the cleaned map
+                predictions[image_number] = (class_accs, f1s,
+                                             classes[i:i + 1].byte().cpu())
+
+            del batch
+
+    fig, axs = make_combined_figure(3)
+
+    with open(csv_file, 'w') as f:
+        csv_writer = csv.writer(f, delimiter='\t')
+        csv_writer.writerow(csv_header)
+
+        for image_number, pure_batch in enumerate(pure_loader):
             input = pure_batch[0]
             target = pure_batch[1]
             fname = pure_batch[2][0]
@@ -320,34 +391,25 @@ def main(args):
 
             del pure_batch
 
-            outputs = module(batch[0].to(torch.device(args.device)))
-            outputs = remove_small_zones(outputs)
+            class_accs, f1s, outputs = predictions[image_number]
+            outputs = outputs.long()
 
-            del batch
+            acc = class_accs.mean()
+            f1 = f1s.mean()
 
             names = ['Input', 'Target', 'Generated image']
 
-            try:
-                class_accs = iou(outputs, target.to(torch.device(args.device)))
-                f1s = PixelWiseF1('all')(outputs, target) * 100
-
-                acc = class_accs.mean()
-                f1 = f1s.mean()
-            except ValueError as e:
-                print('Error on file {}'.format(fname))
-                print(outputs.shape)
-                print(target.shape)
-                raise e
-
-            outputs = torch.argmax(outputs, dim=1)
-
             imgs = [input, target, outputs]
             imgs = [img.detach().cpu().squeeze().numpy() for img in imgs]
 
-            fig, axs = plt.subplots(1, 3)
+            for ax in axs.flatten():
+                ax.clear()
 
             class_names = ['Nothing', 'Bark', 'Node']
 
+            outputs_percents = class_percents(outputs)
+            target_percents = class_percents(target)
+
             for i, ax in enumerate(axs.flatten()):
                 img = imgs[i]
 
@@ -356,25 +418,15 @@ def main(args):
                 if raw:  # Raw input
                     img = img.transpose(1, 2, 0)
 
-                values = np.unique(img.ravel())
-
-                plotted_img = ax.imshow(img, vmax=2)
+                ax.imshow(img, vmin=0, vmax=2)
                 ax.set_title(names[i])
                 ax.axis('off')
 
-                if not raw:  # Predicted image
-                    patches = [
-                        mpatches.Patch(
-                            color=plotted_img.cmap(plotted_img.norm(value)),
-                            label='{} zone'.format(class_names[value]))
-                        for value in values
-                    ]
+            patches = class_legend_patches(outputs_percents, class_names)
 
             suptitle = 'Mean iou : {:.3f}\n'.format(acc)
 
-            for split_idxs, split_name in splits:
-                if image_number in split_idxs:
-                    split = split_name
+            split = split_of[image_number]
 
             running_csv_stats = [fname, wood_type, split]
 
@@ -394,32 +446,28 @@ def main(args):
             running_csv_stats.append('{:.3f}'.format(f1))
 
             for class_idx in [1, 2]:
-                class_percent = (outputs == class_idx).float().mean().cpu()
-                running_csv_stats.append('{:.5f}'.format(class_percent * 100))
+                running_csv_stats.append('{:.5f}'.format(
+                    outputs_percents[class_idx]))
 
             for class_idx in [1, 2]:
-                class_percent = (target == class_idx).float().mean().cpu()
-                running_csv_stats.append('{:.5f}'.format(class_percent * 100))
-
-            fig.legend(handles=patches,
-                       title='Classes',
-                       bbox_to_anchor=(0.4, -0.2, 0.5, 0.5))
-            plt.suptitle(suptitle)
-            plt.tight_layout()
+                running_csv_stats.append('{:.5f}'.format(
+                    target_percents[class_idx]))
+
+            legend = fig.legend(handles=patches,
+                                title='Classes',
+                                bbox_to_anchor=(0.4, -0.2, 0.5, 0.5))
+            fig.suptitle(suptitle)
             # plt.show()
-            plt.savefig(os.path.join(
+            fig.savefig(os.path.join(
                 args.root_dir,
                 'Images/results/moar/combined_images/{}/{}/{}').format(
                     wood_type, split, fname),
                         format='png',
-                        dpi=900)
-            plt.close()
+                        dpi=150,
+                        pil_kwargs={'compress_level': 1})
+            legend.remove()
 
-            outputs = outputs.squeeze().cpu().numpy()
-            dual_outputs = np.zeros((outputs.shape[0], outputs.shape[1]),
-                                    dtype=np.uint8)
-            dual_outputs[outputs == 1] = 127
-            dual_outputs[outputs == 2] = 255
+            dual_outputs = to_dual_image(outputs)
 
             dual = Image.fromarray(dual_outputs, mode='L')
             dual.save(
@@ -427,14 +475,9 @@ def main(args):
                              'Images/results/moar/outputs/{}/{}/{}').format(
                                  wood_type, split, fname))
 
-            results_csv.append(running_csv_stats)
+            csv_writer.writerow(running_csv_stats)
 
-    csv_file = os.path.join(args.root_dir, 'Images', 'results', 'moar',
-                            'final_stats.csv')
-
-    with open(csv_file, 'w') as f:
-        csv_writer = csv.writer(f, delimiter='\t')
-        csv_writer.writerows(results_csv)
+    plt.close(fig)
 
 
 def fix_image(img_number, n_pixels_to_fix, which_to_reduce):
@@ -486,6 +529,12 @@ if __name__ == "__main__":
                         default=42,
                         help='Which random seed to use.')
 
+    parser.add_argument('--deterministic',
+                        action='store_true',
+                        default=False,
+                        help='Train without cuDNN benchmarking and bfloat16 '
+                        'autocast. Slower, but reproducible.')
+
     args = parser.parse_args()
 
     make_training_deterministic(args.seed)
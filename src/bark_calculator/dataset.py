@@ -87,6 +87,9 @@ def pil_loader(path, grayscale=False):
     with open(path, 'rb') as f:
         img = Image.open(f)
         target_format = 'L' if grayscale else 'RGB'
+        # Lets JPEG decoding output the target format directly, no-op for
+        # other formats
+        img.draft(target_format, img.size)
         return img.convert(target_format)
 
 
@@ -114,6 +117,9 @@ class RegressionDatasetFolder(data.Dataset):
             PILImage.
             E.g, ``transforms.Normalize`` for sample images, where
             target is boolean image.
+        image_cache (dict, optional): A dict shared between datasets in which
+            loaded images are stored by path, so that each file is only
+            decoded once per process.
      Attributes:
         samples (list): List of (sample path, target path) tuples
     """
@@ -125,7 +131,8 @@ class RegressionDatasetFolder(data.Dataset):
                  transform=None,
                  input_only_transform=None,
                  include_fname=False,
-                 in_memory=False):
+                 in_memory=False,
+                 image_cache=None):
         samples = make_dataset(root, extensions)
         if len(samples) == 0:
             raise (RuntimeError("Found 0 files in subfolders of: " + root +
@@ -140,6 +147,7 @@ class RegressionDatasetFolder(data.Dataset):
         self.input_only_transform = input_only_transform
         self.include_fname = include_fname
         self.in_memory = in_memory
+        self.image_cache = image_cache
 
         self.filenames = samples
 
@@ -152,13 +160,24 @@ class RegressionDatasetFolder(data.Dataset):
         ram_samples = []
 
         for path, target_path, fname, wood_type in samples:
-            sample = self.loader(path)
-            target = self.loader(target_path, grayscale=True)
+            sample = self.load(path)
+            target = self.load(target_path, grayscale=True)
 
             ram_samples.append((sample, target, fname, wood_type))
 
         return ram_samples
 
+    def load(self, path, grayscale=False):
+        if self.image_cache is None:
+            return self.loader(path, grayscale=grayscale)
+
+        key = (path, grayscale)
+
+        if key not in self.image_cache:
+            self.image_cache[key] = self.loader(path, grayscale=grayscale)
+
+        return self.image_cache[key]
+
     def __getitem__(self, index):
         """
         Args:
@@ -169,8 +188,8 @@ class RegressionDatasetFolder(data.Dataset):
         sample, target, fname, wood_type = self.samples[index]
 
         if not self.in_memory:
-            sample = self.loader(sample)
-            target = self.loader(target, grayscale=True)
+            sample = self.load(sample)
+            target = self.load(target, grayscale=True)
 
         if self.transform is not None:
             random_seed = np.random.randint(2147483647)
@@ -185,7 +204,10 @@ class RegressionDatasetFolder(data.Dataset):
         if self.input_only_transform is not None:
             sample = self.input_only_transform(sample)
 
-        if target is not None:
+        if target is not None and sample.dtype == torch.uint8:
+            # Left in 8 bits, RandomCropFlipCollate scales them once cropped
+            target = target.squeeze(0)
+        elif target is not None:
             if target.max() > 200:
                 target /= 255
 
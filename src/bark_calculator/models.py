@@ -1,4 +1,4 @@
-from utils import remove_small_zones
+from utils import remove_small_zones, to_dual_image, class_pixel_counts, class_legend_patches, get_same_size_batches, make_combined_figure
 from dataset import RegressionDatasetFolder
 
 import torch
@@ -6,42 +6,101 @@ import torch.nn as nn
 from torchvision.models.segmentation.deeplabv3 import DeepLabHead
 from torchvision.models.detection.backbone_utils import IntermediateLayerGetter
 from torchvision.models import resnet
-from torchvision.transforms import ToTensor, Normalize
+from torchvision.transforms import ToTensor
 from torch.utils.data import DataLoader
 from os.path import join
 import numpy as np
-from skimage.transform import resize
+import cv2
 from skimage.io import imsave
 from tqdm import tqdm
+from functools import partial
+from contextlib import nullcontext
+import multiprocessing
 from efficientnet_pytorch import EfficientNet
 import warnings
 
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 from skimage.io import imread, imsave
 import torch
 from PIL import Image
 import csv
 
 
+class InputNormalization(nn.Module):
+    """Batched equivalent of ``transforms.Normalize`` run on the model's device.
+
+    The statistics are non-persistent buffers, so they follow the model
+    across devices without being added to its state dict.
+    """
+
+    def __init__(self, mean, std):
+        super().__init__()
+        self.register_buffer('mean',
+                             torch.tensor(mean).view(1, -1, 1, 1),
+                             persistent=False)
+        self.register_buffer('std',
+                             torch.tensor(std).view(1, -1, 1, 1),
+                             persistent=False)
+
+    def forward(self, x):
+        return (x - self.mean) / self.std
+
+
 class SimpleSegmentationModel(nn.Module):
-    def __init__(self, backbone, classifier):
+    def __init__(self,
+                 backbone,
+                 classifier,
+                 normalization=None,
+                 autocast_dtype=None):
         super(SimpleSegmentationModel, self).__init__()
         self.backbone = backbone
         self.classifier = classifier
+        self.normalization = normalization
+        # When set, e.g. to torch.bfloat16, the forward pass runs under
+        # autocast and returns float32 logits for the loss
+        self.autocast_dtype = autocast_dtype
+
+        # Lets cuDNN pick its NHWC kernels for the convolutions
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, x):
+        if self.autocast_dtype is None:
+            return self._forward(x)
+
+        with torch.autocast(device_type=x.device.type,
+                            dtype=self.autocast_dtype):
+            return self._forward(x).float()
+
+    def _forward(self, x):
         input_shape = x.shape[-2:]
 
+        if self.normalization is not None:
+            x = self.normalization(x)
+
         x = self.backbone(x)["out"]
         x = self.classifier(x)
         x = torch.nn.functional.interpolate(x,
                                             size=input_shape,
-                                            mode='bicubic',
+                                            mode='bilinear',
                                             align_corners=False)
 
         return x
 
+    def predict(self, x):
+        # Inference only forward pass, done in half precision on CUDA. The
+        # outputs are always returned as float32 logits.
+        x = x.contiguous(memory_format=torch.channels_last)
+
+        # CPU autocast warns about float16 even when disabled, so it is
+        # only entered on CUDA
+        if x.is_cuda:
+            autocast = torch.autocast(device_type='cuda', dtype=torch.float16)
+        else:
+            autocast = nullcontext()
+
+        with torch.inference_mode(), autocast:
+            return self(x).float()
+
 
 def deeplabv3_resnet50():
     backbone = resnet.__dict__['resnet50'](
@@ -158,17 +217,30 @@ def trim_black(image):
     summed_image = np.sum(image, axis=-1)
     summed_image = summed_image > 1e-3
 
-    clear_enough_lines_idx = np.mean(summed_image, axis=-1) > 0.85
+    clear_enough_lines_idx = np.flatnonzero(
+        np.mean(summed_image, axis=-1) > 0.85)
 
-    first_idx = np.argmax(clear_enough_lines_idx)
-    last_idx = image.shape[0] - np.argmax(clear_enough_lines_idx[::-1])
+    if len(clear_enough_lines_idx) == 0:
+        return image
+
+    first_idx = clear_enough_lines_idx[0]
+    last_idx = clear_enough_lines_idx[-1] + 1
 
     return image[first_idx:last_idx]
 
 
+def _single_threaded_worker():
+    # Images are already spread over one process per CPU, OpenCV's and
+    # torch's own threads would only oversubscribe them
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+
+
 class Preprocessor():
-    def __init__(self, target_size=1024):
+    def __init__(self, target_size=1024, n_workers=None):
         self.target_size = target_size
+        # None lets the pool use every available CPU
+        self.n_workers = n_workers
 
     def preprocess_images(self, root_path):
         output_path = join(root_path, 'processed')
@@ -176,26 +248,39 @@ class Preprocessor():
                                               input_only_transform=ToTensor(),
                                               include_fname=True)
 
+        # Images are independent, so each worker loads, resizes and saves
+        # its own images instead of sending them through the pool
+        preprocess = partial(self._preprocess_item, raw_dataset, output_path)
+
+        with multiprocessing.Pool(self.n_workers,
+                                  initializer=_single_threaded_worker) as pool:
+            for _ in tqdm(pool.imap_unordered(preprocess,
+                                              range(len(raw_dataset)),
+                                              chunksize=4),
+                          total=len(raw_dataset),
+                          ascii=True,
+                          desc='Preprocessing images'):
+                pass
+
+    def _preprocess_item(self, dataset, output_path, idx):
+        img, _, fname, wood_type = dataset[idx]
+
+        fname = str.replace(fname, '.bmp', '.png')
+        img_output_path = join(output_path, 'samples', wood_type, fname)
+
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            for img, _, fname, wood_type in tqdm(iter(raw_dataset),
-                                                 total=len(raw_dataset),
-                                                 ascii=True,
-                                                 desc='Preprocessing images'):
-                fname = str.replace(fname, '.bmp', '.png')
-                img_output_path = join(output_path, 'samples', wood_type,
-                                       fname)
-
-                self._preprocess_image(img, img_output_path)
+            self._preprocess_image(img, img_output_path)
 
     def _preprocess_image(self, image, output_path):
         image = image.detach().cpu().numpy().transpose(1, 2, 0)
 
         if max(image.shape) > self.target_size:
-            image = resize(image, (self.target_size, self.target_size),
-                           order=3,
-                           mode='reflect',
-                           anti_aliasing=False)
+            image = cv2.resize(np.ascontiguousarray(image),
+                               (self.target_size, self.target_size),
+                               interpolation=cv2.INTER_CUBIC)
+            # Bicubic overshoots around sharp edges, clipped as skimage did
+            image = np.clip(image, 0, 1, out=image)
 
         if image.shape[0] == image.shape[1]:  #Untrimmed
             image = trim_black(image)
@@ -215,59 +300,83 @@ class NeuralBarkCalculator():
                  mean=DEFAULT_MEAN,
                  std=DEFAULT_STD,
                  target_size=1024,
-                 mm_per_pix=DEFAULT_MM_PER_PIXEL):
+                 mm_per_pix=DEFAULT_MM_PER_PIXEL,
+                 compile_model=False,
+                 batch_size=8):
         super().__init__()
         self.device = device
         self.model = fcn_resnet50(pretrained=False)
         self.model.load_state_dict(torch.load(model_path, map_location=device))
+        self.model.normalization = InputNormalization(mean, std)
         self.model.to(device)
+        self.model.eval()
+
+        if compile_model:
+            if hasattr(self.model, 'compile'):
+                self.model.compile(mode='reduce-overhead')
+            else:
+                warnings.warn('This PyTorch version cannot compile models, '
+                              'running the model eagerly.')
         self.mean = mean
         self.std = std
         self.target_size = target_size
         self.device = device
         self.mm_per_pix = mm_per_pix
+        self.batch_size = batch_size
 
     def predict(self, root_path, excludes_nodes):
         output_path = join(root_path, 'results')
         processed_path = join(root_path, 'processed')
-        valid_dataset = RegressionDatasetFolder(processed_path,
-                                                input_only_transform=Normalize(
-                                                    self.mean, self.std),
-                                                transform=ToTensor(),
-                                                include_fname=True)
-
-        pure_dataset = RegressionDatasetFolder(processed_path,
-                                               input_only_transform=None,
-                                               transform=ToTensor(),
-                                               include_fname=True)
-
-        self._predict_images(valid_dataset, pure_dataset, output_path,
-                             excludes_nodes)
-
-    def _predict_images(self, valid_dataset, pure_dataset, output_path,
-                        excludes_nodes):
-        pure_loader = DataLoader(pure_dataset, batch_size=1)
-        valid_loader = DataLoader(valid_dataset, batch_size=1)
-
-        results_csv = [[
+        # The model normalizes its inputs itself, so the same decoded images
+        # are used both for the prediction and for the plots
+        dataset = RegressionDatasetFolder(processed_path,
+                                          input_only_transform=None,
+                                          transform=ToTensor(),
+                                          include_fname=True)
+
+        self._predict_images(dataset, output_path, excludes_nodes)
+
+    def _predict_batches(self, dataset):
+        # Same sized images go through the network together, their outputs
+        # are then yielded one image at a time, along with the image's index
+        # in the dataset, in batch order
+        batches = get_same_size_batches(dataset, self.batch_size)
+        loader = DataLoader(dataset,
+                            batch_sampler=batches,
+                            pin_memory=(self.device != 'cpu'))
+
+        for batch_idxs, batch in zip(batches, loader):
+            outputs = self.model.predict(batch[0].to(self.device,
+                                                     non_blocking=True))
+            outputs = torch.argmax(outputs, dim=1)
+
+            for i, idx in enumerate(batch_idxs):
+                yield (idx, batch[0][i:i + 1], outputs[i:i + 1], batch[2][i],
+                       batch[3][i])
+
+    def _predict_images(self, dataset, output_path, excludes_nodes):
+        csv_header = [
             'Name', 'Type', 'Image Size', 'Output Bark %', 'Bark area (mm^2)',
             'Output Node %', 'Node area (mm^2)'
-        ]]
+        ]
+        csv_file = join(output_path, 'final_stats.csv')
 
-        with torch.no_grad():
-            for image_number, (batch, pure_batch) in tqdm(
-                    enumerate(zip(valid_loader, pure_loader)),
-                    total=len(pure_loader),
-                    ascii=True,
-                    desc='Predicted images'):
-                input = pure_batch[0]
-                fname = pure_batch[2][0]
-                wood_type = pure_batch[3][0]
+        fig, axs = make_combined_figure(2)
+
+        # Images come out grouped by size, only their CSV rows are held back
+        # so the CSV stays in dataset order
+        pending_rows = {}
+        next_idx = 0
 
-                del pure_batch
+        with torch.no_grad(), open(csv_file, 'w') as f:
+            csv_writer = csv.writer(f, delimiter='\t')
+            csv_writer.writerow(csv_header)
 
-                outputs = self.model(batch[0].to(self.device))
-                outputs = torch.argmax(outputs, dim=1)
+            for idx, input, outputs, fname, wood_type in tqdm(
+                    self._predict_batches(dataset),
+                    total=len(dataset),
+                    ascii=True,
+                    desc='Predicted images'):
                 outputs = remove_small_zones(outputs)
 
                 if excludes_nodes:
@@ -275,18 +384,19 @@ class NeuralBarkCalculator():
                     nothing_class = 1
                     outputs[outputs == node_class] = nothing_class
 
-                del batch
-
                 names = ['Input', 'Generated image']
 
                 imgs = [input, outputs]
                 imgs = [img.detach().cpu().squeeze().numpy() for img in imgs]
 
-                fig, axs = plt.subplots(1, 2)
+                for ax in axs.flatten():
+                    ax.clear()
 
                 class_names = ['Nothing', 'Bark', 'Node']
                 class_percents = []
 
+                n_pixels = class_pixel_counts(outputs).tolist()
+
                 for i, ax in enumerate(axs.flatten()):
                     img = imgs[i]
 
@@ -295,40 +405,29 @@ class NeuralBarkCalculator():
                     if raw:  # Raw input
                         img = img.transpose(1, 2, 0)
 
-                    values = np.unique(img.ravel())
-
-                    plotted_img = ax.imshow(img, vmax=2)
+                    ax.imshow(img, vmin=0, vmax=2)
                     ax.set_title(names[i])
                     ax.axis('off')
 
-                    if not raw:  # Predicted image
-                        patches = [
-                            mpatches.Patch(color=plotted_img.cmap(
-                                plotted_img.norm(value)),
-                                           label='{} zone'.format(
-                                               class_names[value]))
-                            for value in values
-                        ]
+                patches = class_legend_patches(n_pixels, class_names)
 
                 img_size = '{} x {}'.format(img.shape[0], img.shape[1])
 
                 running_csv_stats = [fname, wood_type, img_size]
 
-                fig.legend(handles=patches,
-                           title='Classes',
-                           bbox_to_anchor=(0.4, -0.2, 0.5, 0.5))
+                legend = fig.legend(handles=patches,
+                                    title='Classes',
+                                    bbox_to_anchor=(0.4, -0.2, 0.5, 0.5))
 
                 running_csv_stats = [fname, wood_type]
 
                 for class_idx in [1, 2]:
-                    n_pixels = (outputs == class_idx).float().cpu()
-
-                    class_percent = n_pixels.mean()
+                    class_percent = n_pixels[class_idx] / outputs.numel()
                     class_percents.append(class_percent * 100)
                     running_csv_stats.append('{:.5f}'.format(class_percent *
                                                              100))
 
-                    class_area = (n_pixels.sum() * self.mm_per_pix).item()
+                    class_area = n_pixels[class_idx] * self.mm_per_pix
                     running_csv_stats.append('{:.5f}'.format(class_area))
 
                 suptitle = 'Estimated composition percentages\n'
@@ -338,27 +437,23 @@ class NeuralBarkCalculator():
                     suptitle += '{} : {:.3f}\n'.format(class_name,
                                                        class_percent)
 
-                plt.suptitle(suptitle)
-                plt.tight_layout()
-                plt.savefig(join(output_path, 'combined_images', wood_type,
+                fig.suptitle(suptitle)
+                fig.savefig(join(output_path, 'combined_images', wood_type,
                                  fname),
                             format='png',
-                            dpi=900)
-                plt.close()
+                            dpi=150,
+                            pil_kwargs={'compress_level': 1})
+                legend.remove()
 
-                outputs = outputs.squeeze().cpu().numpy()
-                dual_outputs = np.zeros((outputs.shape[0], outputs.shape[1]),
-                                        dtype=np.uint8)
-                dual_outputs[outputs == 1] = 127
-                dual_outputs[outputs == 2] = 255
+                dual_outputs = to_dual_image(outputs)
 
                 dual = Image.fromarray(dual_outputs, mode='L')
                 dual.save(join(output_path, 'outputs', wood_type, fname))
 
-                results_csv.append(running_csv_stats)
+                pending_rows[idx] = running_csv_stats
 
-        csv_file = join(output_path, 'final_stats.csv')
+                while next_idx in pending_rows:
+                    csv_writer.writerow(pending_rows.pop(next_idx))
+                    next_idx += 1
 
-        with open(csv_file, 'w') as f:
-            csv_writer = csv.writer(f, delimiter='\t')
-            csv_writer.writerows(results_csv)
+        plt.close(fig)
@@ -1,3 +1,6 @@
+import matplotlib
+matplotlib.use('Agg')
+
 from models import NeuralBarkCalculator, Preprocessor
 
 import os
@@ -54,7 +57,9 @@ def main(args):
     Preprocessor().preprocess_images(args.root_path)
 
     if not args.only_preprocess:
-        model = NeuralBarkCalculator('./best_model.pt', args.device)
+        model = NeuralBarkCalculator('./best_model.pt',
+                                     args.device,
+                                     compile_model=args.compile)
         model.predict(args.root_path, args.exclude_nodes)
 
 
@@ -73,6 +78,11 @@ if __name__ == '__main__':
 
     parser.add_argument('--only_preprocess', action='store_true', default=False)
 
+    parser.add_argument('--compile',
+                        action='store_true',
+                        default=False,
+                        help='Compile the model with torch.compile first.')
+
     args = parser.parse_args()
 
     if args.device == 'cpu':
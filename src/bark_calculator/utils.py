@@ -1,14 +1,17 @@
-from sklearn.metrics import f1_score
 from dataset import RegressionDatasetFolder
 from lovasz_losses import LovaszSoftmax
 
 from torchvision.transforms import Compose, Resize, ToTensor, ToPILImage, Lambda
 from torchvision.transforms.functional import pad, resize
 from torch.utils.data import DataLoader, SubsetRandomSampler
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.sampler import Sampler, BatchSampler, WeightedRandomSampler
 from torch.nn import CrossEntropyLoss
 from skimage.morphology import remove_small_objects, remove_small_holes
 from poutyne.framework.callbacks import Callback
+from matplotlib import cm
+import matplotlib.patches as mpatches
+import matplotlib.pyplot as plt
 
 from math import ceil, floor, sin, cos
 import numpy as np
@@ -18,6 +21,8 @@ from torchvision.transforms.functional import rotate, center_crop, adjust_bright
 from PIL import Image
 import torch.nn.functional as F
 import random
+import hashlib
+import os
 
 
 def compute_mean_std(working_dataset):
@@ -73,6 +78,41 @@ def get_pos_weight():
     return torch.FloatTensor([0.4004, 2.0334, 93.1921])
 
 
+def get_cached_stats(working_dataset, cache_dir):
+    # The mean, std and class weights only change with the dataset files,
+    # so they are stored on disk under a key made from the files' paths
+    # and modification times
+    key = hashlib.md5()
+
+    for path, target_path, _, _ in working_dataset.filenames:
+        for file_path in (path, target_path):
+            if os.path.isfile(file_path):
+                key.update('{}:{}'.format(
+                    file_path, os.path.getmtime(file_path)).encode())
+
+    cache_path = os.path.join(cache_dir,
+                              'stats_{}.npz'.format(key.hexdigest()))
+
+    if os.path.isfile(cache_path):
+        stats = np.load(cache_path)
+
+        return stats['mean'].tolist(), stats['std'].tolist(), \
+            torch.from_numpy(stats['pos_weights'])
+
+    mean, std = compute_mean_std(working_dataset)
+    pos_weights = compute_pos_weight(working_dataset)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    np.savez(cache_path,
+             mean=np.asarray(mean),
+             std=np.asarray(std),
+             pos_weights=pos_weights.numpy())
+
+    return mean, std, pos_weights
+
+
 def get_splits(dataset):
     train_percent = 0.8
     valid_percent = 0.1
@@ -132,6 +172,24 @@ def get_splits(dataset):
     return train_split, valid_split, test_split, train_weights
 
 
+def get_same_size_batches(dataset, batch_size):
+    # Images are trimmed to different heights, so they can only be
+    # stacked together when their sizes match
+    idxs_by_size = {}
+
+    for idx, (path, _, _, _) in enumerate(dataset.filenames):
+        with Image.open(path) as img:
+            idxs_by_size.setdefault(img.size, []).append(idx)
+
+    batches = []
+
+    for idxs in idxs_by_size.values():
+        for i in range(0, len(idxs), batch_size):
+            batches.append(idxs[i:i + batch_size])
+
+    return batches
+
+
 def remove_small_zones(img):
     device = img.device
     np_image = (img.cpu().numpy() == 0)
@@ -148,6 +206,54 @@ def remove_small_zones(img):
     return img
 
 
+def class_pixel_counts(classes, num_classes=3):
+    # Number of pixels of each class, with a single copy to the CPU
+    return torch.bincount(classes.reshape(-1).long(),
+                          minlength=num_classes).cpu()
+
+
+def class_percents(classes, num_classes=3):
+    counts = class_pixel_counts(classes, num_classes).double()
+
+    return (counts * 100 / classes.numel()).tolist()
+
+
+# Colors given to the classes 0, 1 and 2 by imshow(img, vmin=0, vmax=2)
+CLASS_COLORS = cm.viridis([0., 0.5, 1.])
+
+
+def class_legend_patches(pixel_counts, class_names):
+    return [
+        mpatches.Patch(color=CLASS_COLORS[value],
+                       label='{} zone'.format(class_names[value]))
+        for value, count in enumerate(pixel_counts) if count > 0
+    ]
+
+
+def make_combined_figure(n_panels):
+    # A single figure is reused for every image, only its content is reset,
+    # so its layout is set once here instead of with tight_layout per image
+    fig, axs = plt.subplots(1, n_panels)
+    fig.subplots_adjust(left=0.02,
+                        right=0.98,
+                        top=0.9,
+                        bottom=0.05,
+                        wspace=0.05)
+
+    return fig, axs
+
+
+DUAL_PALETTE = torch.tensor([0, 127, 255], dtype=torch.uint8)
+
+
+def to_dual_image(classes):
+    # Maps a class map to the grey levels of the dual images in a single
+    # lookup, on the class map's device
+    palette = DUAL_PALETTE.to(classes.device)
+
+    return palette[classes.long()].squeeze().cpu().numpy()
+
+
 class CustomWeightedCrossEntropy(nn.Module):
     def __init__(self, weights):
         super(CustomWeightedCrossEntropy, self).__init__()
@@ -198,6 +304,22 @@ def make_training_deterministic(seed):
     random.seed(seed)
 
 
+def pixel_wise_f1(labels, outputs, num_classes=3):
+    # Per class F1 scores from a confusion matrix built on the tensors'
+    # device, rows being the labels and columns the outputs
+    idxs = labels.reshape(-1) * num_classes + outputs.reshape(-1)
+    confusion = torch.bincount(idxs, minlength=num_classes**2).view(
+        num_classes, num_classes)
+
+    tp = confusion.diag()
+    fp = confusion.sum(0) - tp
+    fn = confusion.sum(1) - tp
+
+    scores = 2 * tp.double() / (2 * tp + fp + fn).clamp(min=1).double()
+
+    return scores, confusion
+
+
 class PixelWiseF1(nn.Module):
     def __init__(self, class_to_watch):
         super().__init__()
@@ -213,13 +335,13 @@ class PixelWiseF1(nn.Module):
 
         outputs = remove_small_zones(outputs)
 
-        outputs = outputs.cpu().reshape(-1)
-        labels = labels.cpu().reshape(-1)
+        scores, confusion = pixel_wise_f1(labels.to(outputs.device), outputs)
 
-        scores = f1_score(labels, outputs, labels=[0, 1, 2], average=None)
+        scores = scores.cpu().numpy()
+        confusion = confusion.cpu().numpy()
 
-        targets_count = np.bincount(labels, minlength=3)
-        outputs_count = np.bincount(outputs, minlength=3)
+        targets_count = confusion.sum(1)
+        outputs_count = confusion.sum(0)
 
         for i, count_i in enumerate(targets_count):
             if count_i == 0 and outputs_count[i] == 0:
@@ -351,6 +473,55 @@ class NormColorJitter(object):
         return format_string
 
 
+class RandomCropFlipCollate(object):
+    """Collates a batch of same sized (sample, target) pairs, then applies
+    a random crop and random horizontal and vertical flips to each pair.
+
+    The crop and both flips are done with a single indexing of the stacked
+    tensors instead of per image PIL operations. The pairs are expected as
+    uint8 tensors (PILToTensor), which are only converted to float samples
+    and class targets once cropped.
+
+        Args:
+            crop_size (int): Size of the square crops.
+        """
+
+    def __init__(self, crop_size):
+        self.crop_size = crop_size
+
+    def __call__(self, batch):
+        samples, targets = default_collate(batch)
+        batch_size, _, height, width = samples.shape
+
+        offsets = torch.arange(self.crop_size)
+        tops = torch.randint(height - self.crop_size + 1, (batch_size, 1))
+        lefts = torch.randint(width - self.crop_size + 1, (batch_size, 1))
+        rows = tops + offsets
+        cols = lefts + offsets
+
+        flip_rows = torch.rand(batch_size, 1) < 0.5
+        flip_cols = torch.rand(batch_size, 1) < 0.5
+        rows = torch.where(flip_rows, rows.flip(1), rows)
+        cols = torch.where(flip_cols, cols.flip(1), cols)
+
+        batch_idxs = torch.arange(batch_size).view(-1, 1, 1)
+        rows = rows.unsqueeze(2)
+        cols = cols.unsqueeze(1)
+
+        samples = samples.permute(0, 2, 3, 1)[batch_idxs, rows, cols]
+        samples = samples.permute(0, 3, 1, 2).contiguous()
+        targets = targets[batch_idxs, rows, cols]
+
+        samples = samples.float().div_(255)
+        targets = (targets.float() * (2 / 255)).round_().long()
+
+        return samples, targets
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(crop_size={0})'.format(
+            self.crop_size)
+
+
 class PrioritizedBatchSampler(BatchSampler):
     def __init__(self,
                  num_samples,
@@ -398,18 +569,21 @@ class PrioritizedBatchSamplerUpdate(Callback):
         self.weights = sampler.sampler.sampler.weights
 
     def collect_batch(self, batch_idxs):
-        self.running_batch_idxs = batch_idxs
+        self.running_batch_idxs = torch.as_tensor(batch_idxs,
+                                                  dtype=torch.long)
 
     def on_batch_end(self, batch, logs):
-        self.num_visited[self.running_batch_idxs] += 1
-        n_visits = self.num_visited[self.running_batch_idxs]
-        weights = self.weights[self.running_batch_idxs]
+        idxs = self.running_batch_idxs
+        self.num_visited[idxs] += 1
+        n_visits = self.num_visited[idxs].to(self.weights.dtype)
         metric_value = logs[self.metric]
         if self.metric_mode == 'min':
             metric_value = 1 - metric_value
-        metric_value = torch.ones_like(n_visits) * metric_value
-        self.weights[self.running_batch_idxs] = weights * (
-            n_visits - 1) / n_visits + metric_value / n_visits
+
+        # Running mean of the metric, updated in place on the gathered weights
+        weights = self.weights[idxs]
+        weights.mul_(n_visits - 1).add_(metric_value).div_(n_visits)
+        self.weights[idxs] = weights
 
     def on_train_end(self, logs):
         print("\n*** Prioritized sampler stats ***")